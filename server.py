@@ -1,12 +1,18 @@
-from fastapi import FastAPI, Query, HTTPException
-from datetime import datetime, timedelta
-import os, pytz, httpx
+from fastapi import FastAPI, Query, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
+from datetime import date as date_cls, datetime, timedelta
+from zoneinfo import ZoneInfo
+import os, time, asyncio, hashlib, logging, httpx, orjson
 
-app = FastAPI()
-HK_TZ = pytz.timezone("Asia/Hong_Kong")
+app = FastAPI(default_response_class=ORJSONResponse)
+logger = logging.getLogger(__name__)
+_TZ_NAME = "Asia/Hong_Kong"
+HK_TZ = ZoneInfo(_TZ_NAME)
 
 # Core auth
 CAL_API_KEY = os.environ.get("CAL_API_KEY")  # cal_live_...
+# Built once; cal-api-version is already a default header on the shared client
+_AUTH_HEADERS = {"Authorization": f"Bearer {CAL_API_KEY}"} if CAL_API_KEY else None
 
 # Legacy default for Sai Kung kept to avoid breaking existing /open/hk
 SCHEDULE_ID = "964634"
@@ -18,11 +24,141 @@ SCHEDULE_IDS = {
     "pp": os.environ.get("SCHEDULE_ID_PP") or "964639",     # Pacific Place (Admiralty)
     "oie": os.environ.get("SCHEDULE_ID_OIE") or "964642",   # One Island East (Quarry Bay)
 }
+_SCHEDULE_URLS = {sid: f"https://api.cal.com/v2/schedules/{sid}" for sid in SCHEDULE_IDS.values()}
+
+# Indexed by isoweekday() (1=Monday); index 0 unused
+WEEKDAY_NAMES = ("", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+WEEKDAY_NUM_TO_NAME = {n: WEEKDAY_NAMES[n] for n in range(1, 8)}  # legacy alias
+
+# Shared upstream client: keep-alive + HTTP/2 to cal.com, created at startup
+_client: httpx.AsyncClient | None = None
+_refresh_task: asyncio.Task | None = None
+
+
+@app.on_event("startup")
+async def _startup():
+    global _client, _refresh_task
+    _client = httpx.AsyncClient(
+        http2=True,
+        timeout=8.0,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        headers={"cal-api-version": "2024-06-11"},
+    )
+
+    # Warm the schedule cache for every location, then keep it fresh
+    if CAL_API_KEY:
+        await _prefetch_schedules()
+        _refresh_task = asyncio.create_task(_refresh_loop())
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+    if _client is not None:
+        await _client.aclose()
+
+
+# Schedules change rarely: cache indexed cal.com payloads per schedule id
+SCHEDULE_TTL = 60  # seconds
+SCHEDULE_REFRESH = SCHEDULE_TTL * 0.8  # refresh before entries expire so requests never miss
+STALE_RETRY_AFTER = 5  # seconds to keep serving a stale schedule before retrying cal.com
+_schedule_cache: dict[str, tuple[float, dict]] = {}  # schedule id -> (fetched at, index)
+_schedule_fetches: dict[str, asyncio.Task] = {}  # schedule id -> in-flight fetch
+
+
+def _is_fresh(cached: tuple[float, dict] | None) -> bool:
+    return bool(cached) and time.monotonic() - cached[0] < SCHEDULE_TTL
+
+
+def _serve_stale(schedule_id: str, cached: tuple[float, dict]) -> dict:
+    # Keep the stale entry "fresh" for a short backoff so callers don't each retry a failing upstream
+    _schedule_cache[schedule_id] = (time.monotonic() - SCHEDULE_TTL + STALE_RETRY_AFTER, cached[1])
+    return cached[1]
+
+
+async def _fetch_schedule(schedule_id: str) -> dict:
+    cached = _schedule_cache.get(schedule_id)
+    url = _SCHEDULE_URLS.get(schedule_id) or f"https://api.cal.com/v2/schedules/{schedule_id}"
+    # Stale-on-error: if cal.com is down or rate limiting, keep serving the last good schedule
+    try:
+        r = await _client.get(url, headers=_AUTH_HEADERS)
+    except httpx.TransportError:
+        if cached:
+            return _serve_stale(schedule_id, cached)
+        raise HTTPException(status_code=502, detail="cal.com unreachable")
+    if r.status_code >= 400:
+        if (r.status_code >= 500 or r.status_code == 429) and cached:
+            return _serve_stale(schedule_id, cached)
+        raise HTTPException(status_code=502, detail=f"cal.com returned {r.status_code}")
+    idx = index_schedule(orjson.loads(r.content))
+    # Content hash: stable across workers and across refreshes that return the same schedule
+    idx["version"] = hashlib.blake2b(r.content, digest_size=8).hexdigest()
+    _schedule_cache[schedule_id] = (time.monotonic(), idx)
+    return idx
+
+
+def _fetch_done(schedule_id: str, task: asyncio.Task):
+    if _schedule_fetches.get(schedule_id) is task:
+        del _schedule_fetches[schedule_id]
+    # Mark any error as retrieved; the callers awaiting the task handle it
+    if not task.cancelled():
+        task.exception()
+
+
+def _start_fetch(schedule_id: str) -> asyncio.Task:
+    task = _schedule_fetches.get(schedule_id)
+    if task is None:
+        task = asyncio.create_task(_fetch_schedule(schedule_id))
+        _schedule_fetches[schedule_id] = task
+        task.add_done_callback(lambda t: _fetch_done(schedule_id, t))
+    return task
+
+
+def _revalidate_done(schedule_id: str, task: asyncio.Task):
+    if task.cancelled() or task.exception() is None:
+        return
+    # Nobody awaits a background refetch: log it and back off so each request doesn't retry
+    logger.warning("Background refetch of schedule %s failed", schedule_id, exc_info=task.exception())
+    cached = _schedule_cache.get(schedule_id)
+    if cached:
+        _serve_stale(schedule_id, cached)
+
+
+async def _get_schedule(schedule_id: str, no_cache: bool = False) -> dict:
+    cached = _schedule_cache.get(schedule_id)
+    if not no_cache and _is_fresh(cached):
+        return cached[1]
+
+    # Stale-while-revalidate: answer from the expired entry now and refetch in the background,
+    # so only a cold cache ever waits on cal.com
+    if not no_cache and cached:
+        if schedule_id not in _schedule_fetches:
+            _start_fetch(schedule_id).add_done_callback(lambda t: _revalidate_done(schedule_id, t))
+        return cached[1]
+
+    # Single-flight: concurrent misses share one in-flight fetch, including its error,
+    # so a slow or failing upstream costs one timeout rather than one per waiter.
+    # shield() keeps a disconnecting caller from cancelling the fetch for the others.
+    return await asyncio.shield(_start_fetch(schedule_id))
+
 
-WEEKDAY_NUM_TO_NAME = {
-    1: "Monday", 2: "Tuesday", 3: "Wednesday", 4: "Thursday",
-    5: "Friday", 6: "Saturday", 7: "Sunday"
-}
+async def _prefetch_one(schedule_id: str, no_cache: bool = False):
+    # One upstream failure must not abort startup or the refresh loop
+    try:
+        await _get_schedule(schedule_id, no_cache=no_cache)
+    except Exception:
+        logger.warning("Prefetch of schedule %s failed", schedule_id, exc_info=True)
+
+
+async def _prefetch_schedules(no_cache: bool = False):
+    await asyncio.gather(*[_prefetch_one(sid, no_cache) for sid in set(SCHEDULE_IDS.values())])
+
+
+async def _refresh_loop():
+    while True:
+        await asyncio.sleep(SCHEDULE_REFRESH)
+        await _prefetch_schedules(no_cache=True)
 
 
 @app.get("/")
@@ -30,98 +166,153 @@ def root():
     return {"status": "ok", "paths": ["/time/hk", "/open/hk", "/open/kt", "/open/pp", "/open/oie"]}
 
 
+# async: nothing here blocks, so stay on the event loop instead of the threadpool
 @app.get("/time/hk")
-def time_hk():
+async def time_hk():
     now = datetime.now(HK_TZ)
-    return {"datetime": now.isoformat(), "weekdayNum": now.isoweekday(), "timezone": "Asia/Hong_Kong"}
+    return {"datetime": now.isoformat(), "weekdayNum": now.isoweekday(), "timezone": _TZ_NAME}
 
 
-def to_hk_date(date_str: str | None, offset_days: int | None) -> datetime:
-    now_hk = datetime.now(HK_TZ)
+def to_hk_date(date_str: str | None, offset_days: int | None, now_hk: datetime | None = None) -> datetime:
+    now_hk = now_hk or datetime.now(HK_TZ)
     if date_str:
-        return HK_TZ.localize(datetime.strptime(date_str, "%Y-%m-%d"))
+        try:
+            d = date_cls.fromisoformat(date_str)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="date must be YYYY-MM-DD") from None
+        # fromisoformat also accepts other ISO shapes (20240306, 2024-W10-3); require YYYY-MM-DD
+        if d.isoformat() != date_str:
+            raise HTTPException(status_code=400, detail="date must be YYYY-MM-DD")
+        return datetime(d.year, d.month, d.day, tzinfo=HK_TZ)
     if offset_days is not None:
         return (now_hk + timedelta(days=offset_days)).replace(hour=0, minute=0, second=0, microsecond=0)
     return now_hk.replace(hour=0, minute=0, second=0, microsecond=0)
 
 
-def pick_hours(payload: dict, target_date_hk: datetime):
+def parse_hhmm(hhmm: str | None) -> tuple[int, int] | None:
+    if not hhmm:
+        return None
+    hh, mm = map(int, hhmm.split(":"))
+    if not (0 <= hh < 24 and 0 <= mm < 60):
+        raise ValueError(hhmm)
+    return hh, mm
+
+
+def _hours_entry(start: str | None, end: str | None):
+    # Raw strings for the response, parsed (hour, minute) pairs for date math.
+    # A malformed entry counts as closed rather than failing the whole schedule.
+    try:
+        return start, end, parse_hhmm(start), parse_hhmm(end)
+    except ValueError:
+        logger.warning("Ignoring malformed cal.com hours %r-%r; treating as closed", start, end)
+        return None, None, None, None
+
+
+def index_schedule(payload: dict) -> dict:
+    # Pre-index a cal.com payload once per fetch so lookups are O(1) per request
     data = payload.get("data", {}) or {}
     overrides = data.get("overrides", []) or []
     availability = data.get("availability", []) or []
-    tz = data.get("timeZone", "Asia/Hong_Kong")
-    target_date_str = target_date_hk.strftime("%Y-%m-%d")
 
-    # Date-specific override takes precedence
+    # First match wins, same as a linear scan over the lists
+    by_date: dict[str, tuple] = {}
     for ov in overrides:
-        if ov.get("date") == target_date_str:
-            start = ov.get("startTime")
-            end = ov.get("endTime")
-            is_open = bool(start and end)
-            return is_open, start, end, tz
-
-    # Otherwise, use weekday block
-    weekday_name = WEEKDAY_NUM_TO_NAME[target_date_hk.isoweekday()]
+        if ov.get("date") not in by_date:
+            by_date[ov.get("date")] = _hours_entry(ov.get("startTime"), ov.get("endTime"))
+
+    by_weekday: dict[str, tuple] = {}
     for block in availability:
-        days = block.get("days") or []
-        if weekday_name in days:
-            start = block.get("startTime")
-            end = block.get("endTime")
-            is_open = bool(start and end)
-            return is_open, start, end, tz
+        entry = _hours_entry(block.get("startTime"), block.get("endTime"))
+        for day in block.get("days") or []:
+            by_weekday.setdefault(day, entry)
 
-    return False, None, None, tz
+    return {"tz": data.get("timeZone", _TZ_NAME), "by_date": by_date, "by_weekday": by_weekday}
 
-def make_hk_datetime(date_hk: datetime, hhmm: str | None) -> datetime | None:
-    if not hhmm:
-        return None
-    hh, mm = map(int, hhmm.split(":"))
-    return date_hk.replace(hour=hh, minute=mm, second=0, microsecond=0)
 
-def compute_now_status(target_date_hk: datetime, start: str | None, end: str | None) -> tuple[bool | None, str]:
+def pick_hours(idx: dict, target_date_str: str, weekday_name: str):
+    # Returns (is_open, start, end, start_hm, end_hm, tz).
+    # Date-specific override takes precedence, otherwise use weekday block
+    entry = idx["by_date"].get(target_date_str) or idx["by_weekday"].get(weekday_name)
+    if not entry:
+        return False, None, None, None, None, idx["tz"]
+    start, end, start_hm, end_hm = entry
+    return bool(start and end), start, end, start_hm, end_hm, idx["tz"]
+
+def make_hk_datetime(date_hk: datetime, hm: tuple[int, int] | None) -> datetime | None:
+    if not hm:
+        return None
+    return date_hk.replace(hour=hm[0], minute=hm[1], second=0, microsecond=0)
+
+def compute_now_status(
+    target_date_hk: datetime,
+    start_hm: tuple[int, int] | None,
+    end_hm: tuple[int, int] | None,
+    now_hk: datetime | None = None,
+) -> tuple[bool | None, str]:
     # Returns (openNow, status). openNow is None if target date != today.
-    now_hk = datetime.now(HK_TZ)
+    now_hk = now_hk or datetime.now(HK_TZ)
     if target_date_hk.date() != now_hk.date():
         return None, "not_today"
 
-    start_dt = make_hk_datetime(target_date_hk, start)
-    end_dt = make_hk_datetime(target_date_hk, end)
-    if not start_dt or not end_dt:
+    if not start_hm or not end_hm:
         return False, "closed"
 
-    if now_hk < start_dt:
+    # Same day, so comparing (hour, minute) matches comparing full datetimes
+    now_hm = (now_hk.hour, now_hk.minute)
+    if now_hm < start_hm:
         return False, "before_open"
-    if start_dt <= now_hk < end_dt:
+    if start_hm <= now_hm < end_hm:
         return True, "open"
     return False, "after_close"
 
 
+def _wants_no_cache(request: Request) -> bool:
+    return "no-cache" in request.headers.get("cache-control", "").lower()
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    # RFC 9110 weak comparison: comma-separated list, W/ prefixes ignored, "*" matches anything.
+    # Proxies (e.g. nginx gzip) weaken strong tags, so exact equality would never hit.
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
 
-async def compute_open(schedule_id: str, date: str | None, offsetDays: int | None):
+async def compute_open(schedule_id: str, date: str | None, offsetDays: int | None, request: Request, response: Response):
     if not CAL_API_KEY:
         raise HTTPException(status_code=500, detail="Missing CAL_API_KEY")
     if not schedule_id:
         raise HTTPException(status_code=500, detail="Missing schedule id for this location")
 
-    target_date_hk = to_hk_date(date, offsetDays)
-    headers = {"Authorization": f"Bearer {CAL_API_KEY}", "cal-api-version": "2024-06-11"}
-    url = f"https://api.cal.com/v2/schedules/{schedule_id}"
+    # One clock read per request keeps "today" consistent across helpers
+    now_hk = datetime.now(HK_TZ)
+    target_date_hk = to_hk_date(date, offsetDays, now_hk)
+    idx = await _get_schedule(schedule_id, no_cache=_wants_no_cache(request))
 
-    async with httpx.AsyncClient(timeout=8) as client:
-        r = await client.get(url, headers=headers)
-        r.raise_for_status()
-        payload = r.json()
+    date_str = target_date_hk.strftime("%Y-%m-%d")
+    weekday_name = WEEKDAY_NAMES[target_date_hk.isoweekday()]
+    is_open, start, end, start_hm, end_hm, tz = pick_hours(idx, date_str, weekday_name)
 
-    is_open, start, end, tz = pick_hours(payload, target_date_hk)
+    open_now, status = compute_now_status(target_date_hk, start_hm, end_hm, now_hk=now_hk)  # None if not today
 
-    open_now, status = compute_now_status(target_date_hk, start, end)  # None if not today
+    # The body is fully determined by the schedule, the date and the live status
+    etag_key = f"{schedule_id}:{idx['version']}:{date_str}:{status}".encode()
+    etag = f'"{hashlib.blake2b(etag_key, digest_size=8).hexdigest()}"'
+    cache_headers = {"ETag": etag, "Cache-Control": f"max-age={SCHEDULE_TTL}"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=cache_headers)
+    response.headers.update(cache_headers)
 
-    start_iso = make_hk_datetime(target_date_hk, start).isoformat() if start else None
-    end_iso = make_hk_datetime(target_date_hk, end).isoformat() if end else None
+    start_iso = make_hk_datetime(target_date_hk, start_hm).isoformat() if start_hm else None
+    end_iso = make_hk_datetime(target_date_hk, end_hm).isoformat() if end_hm else None
 
     return {
-        "date": target_date_hk.strftime("%Y-%m-%d"),
-        "weekday": WEEKDAY_NUM_TO_NAME[target_date_hk.isoweekday()],
+        "date": date_str,
+        "weekday": weekday_name,
         "timezone": tz,
         "open": is_open,
         "start": start,
@@ -136,15 +327,36 @@ async def compute_open(schedule_id: str, date: str | None, offsetDays: int | Non
 # Keep original Sai Kung route and contract
 @app.get("/open/hk")
 async def open_for_date_hk(
+    request: Request,
+    response: Response,
     date: str | None = Query(default=None, description="YYYY-MM-DD in Asia/Hong_Kong"),
     offsetDays: int | None = Query(default=None, description="0=today, 1=tomorrow, 2=day after"),
 ):
-    return await compute_open(SCHEDULE_IDS["hk"], date, offsetDays)
+    return await compute_open(SCHEDULE_IDS["hk"], date, offsetDays, request, response)
+
+
+# Static routes for the other locations (kt, pp, oie), each bound to its schedule id
+def _make_open_route(schedule_id: str):
+    async def handler(
+        request: Request,
+        response: Response,
+        date: str | None = Query(default=None, description="YYYY-MM-DD in Asia/Hong_Kong"),
+        offsetDays: int | None = Query(default=None, description="0=today, 1=tomorrow, 2=day after"),
+    ):
+        return await compute_open(schedule_id, date, offsetDays, request, response)
+    return handler
+
 
+for _key, _sid in SCHEDULE_IDS.items():
+    if _key != "hk":
+        app.get(f"/open/{_key}", name=f"open_for_date_{_key}")(_make_open_route(_sid))
 
-# New: generic location route (supports kt, pp, oie)
+
+# Fallback for mixed-case keys (e.g. /open/KT) and unknown locations
 @app.get("/open/{loc}")
 async def open_for_date_loc(
+    request: Request,
+    response: Response,
     loc: str,
     date: str | None = Query(default=None, description="YYYY-MM-DD in Asia/Hong_Kong"),
     offsetDays: int | None = Query(default=None, description="0=today, 1=tomorrow, 2=day after"),
@@ -152,6 +364,20 @@ async def open_for_date_loc(
     key = (loc or "").lower()
     if key not in SCHEDULE_IDS:
         raise HTTPException(status_code=404, detail="Unknown location")
-    return await compute_open(SCHEDULE_IDS[key], date, offsetDays)
-
-
+    return await compute_open(SCHEDULE_IDS[key], date, offsetDays, request, response)
+
+
+# Local/production launch: uvloop event loop + httptools parser
+# (both ship with uvicorn[standard]). Equivalent CLI:
+#   uvicorn server:app --loop uvloop --http httptools --workers N
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "server:app",
+        host=os.environ.get("HOST", "0.0.0.0"),
+        port=int(os.environ.get("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.environ.get("WEB_CONCURRENCY", "1")),
+    )
@@ -0,0 +1,273 @@
+import asyncio
+import time
+from datetime import datetime
+
+import httpx
+import pytest
+
+import server
+
+SCHEDULE = {
+    "data": {
+        "timeZone": "Asia/Hong_Kong",
+        "overrides": [],
+        "availability": [{"days": ["Wednesday"], "startTime": "09:00", "endTime": "18:00"}],
+    }
+}
+
+
+class Upstream:
+    """Mock cal.com: counts calls and answers with `status` after `delay` seconds, or once `gate` is set."""
+
+    def __init__(self):
+        self.calls = 0
+        self.status = 200
+        self.delay = 0.0
+        self.gate: asyncio.Event | None = None
+        self.fail_ids: set[str] = set()
+        self.schedule_ids: list[str] = []
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        self.schedule_ids.append(request.url.path.rsplit("/", 1)[-1])
+        await asyncio.sleep(self.delay)
+        if self.gate is not None:
+            await self.gate.wait()
+        if request.url.path.rsplit("/", 1)[-1] in self.fail_ids:
+            return httpx.Response(500)
+        if self.status != 200:
+            return httpx.Response(self.status)
+        return httpx.Response(200, json=SCHEDULE)
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    up = Upstream()
+    monkeypatch.setattr(server, "CAL_API_KEY", "cal_test")
+    monkeypatch.setattr(server, "_AUTH_HEADERS", {"Authorization": "Bearer cal_test"})
+    monkeypatch.setattr(server, "_client", httpx.AsyncClient(transport=httpx.MockTransport(up.handler)))
+    monkeypatch.setattr(server, "_schedule_cache", {})
+    monkeypatch.setattr(server, "_schedule_fetches", {})
+    return up
+
+
+def set_now(monkeypatch, now: datetime):
+    class FixedDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+
+    monkeypatch.setattr(server, "datetime", FixedDatetime)
+
+
+async def get(path: str, headers: dict | None = None, n: int = 1) -> list[httpx.Response]:
+    # No lifespan: the fixture installs the mocked upstream client instead of startup
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await asyncio.gather(*[client.get(path, headers=headers) for _ in range(n)])
+
+
+def expire(schedule_id: str):
+    ts, idx = server._schedule_cache[schedule_id]
+    server._schedule_cache[schedule_id] = (ts - server.SCHEDULE_TTL, idx)
+
+
+async def drain_fetches():
+    await asyncio.gather(*server._schedule_fetches.values(), return_exceptions=True)
+
+
+def test_if_none_match_returns_304(upstream):
+    async def run():
+        (first,) = await get("/open/hk?date=2024-03-06")
+        etag = first.headers["etag"]
+        (second,) = await get("/open/hk?date=2024-03-06", headers={"If-None-Match": etag})
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first.status_code == 200
+    assert first.json()["open"] is True
+    assert second.status_code == 304
+    assert second.headers["etag"] == first.headers["etag"]
+    assert second.content == b""
+
+
+def test_etag_changes_with_status(upstream, monkeypatch):
+    async def at(hour: int) -> httpx.Response:
+        set_now(monkeypatch, datetime(2024, 3, 6, hour, 30, tzinfo=server.HK_TZ))
+        (r,) = await get("/open/hk")
+        return r
+
+    async def run():
+        return await at(8), await at(10)
+
+    before, during = asyncio.run(run())
+    assert before.json()["status"] == "before_open"
+    assert during.json()["status"] == "open"
+    assert before.headers["etag"] != during.headers["etag"]
+
+
+@pytest.mark.parametrize(
+    "header",
+    ["W/{etag}", '"other", {etag}', 'W/"other", W/{etag}', "*"],
+)
+def test_if_none_match_weak_list_and_star(upstream, header):
+    async def run():
+        (first,) = await get("/open/hk?date=2024-03-06")
+        value = header.format(etag=first.headers["etag"])
+        (second,) = await get("/open/hk?date=2024-03-06", headers={"If-None-Match": value})
+        return second
+
+    assert asyncio.run(run()).status_code == 304
+
+
+def test_if_none_match_mismatch_returns_200(upstream):
+    (r,) = asyncio.run(get("/open/hk?date=2024-03-06", headers={"If-None-Match": 'W/"other"'}))
+    assert r.status_code == 200
+
+
+def test_concurrent_misses_share_one_fetch(upstream):
+    upstream.delay = 0.05
+    responses = asyncio.run(get("/open/kt?date=2024-03-06", n=5))
+    assert [r.status_code for r in responses] == [200] * 5
+    assert upstream.calls == 1
+
+
+def test_concurrent_cold_misses_share_one_failure(upstream):
+    upstream.status = 503
+    upstream.delay = 0.05
+    responses = asyncio.run(get("/open/hk?date=2024-03-06", n=5))
+    assert [r.status_code for r in responses] == [502] * 5
+    assert upstream.calls == 1
+
+
+def test_no_cache_header_bypasses_cache(upstream):
+    async def run():
+        await get("/open/hk?date=2024-03-06")
+        await get("/open/hk?date=2024-03-06")
+        cached_calls = upstream.calls
+        await get("/open/hk?date=2024-03-06", headers={"Cache-Control": "no-cache"})
+        return cached_calls
+
+    assert asyncio.run(run()) == 1
+    assert upstream.calls == 2
+
+
+@pytest.mark.parametrize("status", [503, 429, 401])
+def test_stale_on_error(upstream, status):
+    sid = server.SCHEDULE_IDS["hk"]
+
+    async def run():
+        (fresh,) = await get("/open/hk?date=2024-03-06")
+        expire(sid)
+        upstream.status = status
+        stale = await get("/open/hk?date=2024-03-06", n=5)
+        await drain_fetches()
+        # The failed refetch backs off, so the next burst is served from cache
+        again = await get("/open/hk?date=2024-03-06", n=5)
+        return fresh, stale + again
+
+    fresh, stale = asyncio.run(run())
+    assert [r.status_code for r in stale] == [200] * 10
+    assert all(r.json() == fresh.json() for r in stale)
+    assert upstream.calls == 2
+
+
+def test_stale_is_served_without_waiting_for_upstream(upstream):
+    sid = server.SCHEDULE_IDS["hk"]
+
+    async def run():
+        await get("/open/hk?date=2024-03-06")
+        expire(sid)
+        upstream.gate = asyncio.Event()
+        # Upstream cannot answer until the gate opens, so this only returns if it doesn't wait
+        (stale,) = await get("/open/hk?date=2024-03-06")
+        pending = bool(server._schedule_fetches)
+        upstream.gate.set()
+        await drain_fetches()
+        return stale, pending
+
+    stale, pending = asyncio.run(run())
+    assert stale.status_code == 200
+    assert pending
+    assert upstream.calls == 2
+    assert time.monotonic() - server._schedule_cache[sid][0] < server.SCHEDULE_TTL
+
+
+def test_error_without_cache_is_502(upstream):
+    upstream.status = 503
+    (r,) = asyncio.run(get("/open/hk?date=2024-03-06"))
+    assert r.status_code == 502
+
+
+def test_prefetch_failure_does_not_stop_other_schedules(upstream, caplog):
+    failing = server.SCHEDULE_IDS["kt"]
+    upstream.fail_ids = {failing}
+    asyncio.run(server._prefetch_schedules())
+    assert set(server._schedule_cache) == set(server.SCHEDULE_IDS.values()) - {failing}
+    assert f"Prefetch of schedule {failing} failed" in caplog.text
+
+
+def test_refresh_loop_refetches_every_schedule(upstream, monkeypatch):
+    monkeypatch.setattr(server, "SCHEDULE_REFRESH", 0)
+    n = len(set(server.SCHEDULE_IDS.values()))
+
+    async def run():
+        task = asyncio.create_task(server._refresh_loop())
+        while upstream.calls < 2 * n:
+            await asyncio.sleep(0)
+        task.cancel()
+
+    asyncio.run(asyncio.wait_for(run(), timeout=5))
+    assert set(server._schedule_cache) == set(server.SCHEDULE_IDS.values())
+
+
+@pytest.mark.parametrize("value", ["2024-W10-3", "20240306", "2024-3-6", "2024-02-30", "x"])
+def test_malformed_date_is_400(upstream, value):
+    (r,) = asyncio.run(get(f"/open/hk?date={value}"))
+    assert r.status_code == 400
+
+
+def test_iso_date_is_accepted(upstream):
+    (r,) = asyncio.run(get("/open/hk?date=2024-03-06"))
+    assert r.status_code == 200
+    assert r.json()["date"] == "2024-03-06"
+    assert r.json()["weekday"] == "Wednesday"
+
+
+def test_malformed_hours_only_close_that_entry(upstream, monkeypatch):
+    monkeypatch.setitem(SCHEDULE, "data", {
+        "overrides": [{"date": "2024-03-06", "startTime": "09:00:00", "endTime": "18:00"}],
+        "availability": [{"days": ["Wednesday"], "startTime": "09:00", "endTime": "18:00"}],
+    })
+
+    async def run():
+        (bad,) = await get("/open/hk?date=2024-03-06")
+        (good,) = await get("/open/hk?date=2024-03-13")
+        return bad, good
+
+    bad, good = asyncio.run(run())
+    assert bad.status_code == 200 and bad.json()["open"] is False
+    assert good.status_code == 200 and good.json()["open"] is True
+    assert good.json()["startIso"] == "2024-03-13T09:00:00+08:00"
+
+
+@pytest.mark.parametrize("path, key", [
+    ("/open/kt", "kt"), ("/open/pp", "pp"), ("/open/oie", "oie"), ("/open/KT", "kt"), ("/open/Oie", "oie"),
+])
+def test_location_routes_use_their_schedule(upstream, path, key):
+    (r,) = asyncio.run(get(f"{path}?date=2024-03-06"))
+    assert r.status_code == 200
+    assert upstream.schedule_ids == [server.SCHEDULE_IDS[key]]
+
+
+def test_unknown_location_is_404(upstream):
+    (r,) = asyncio.run(get("/open/nowhere"))
+    assert r.status_code == 404
+    assert upstream.calls == 0
+
+
+def test_time_hk(monkeypatch):
+    set_now(monkeypatch, datetime(2024, 3, 6, 9, 30, tzinfo=server.HK_TZ))
+    (r,) = asyncio.run(get("/time/hk"))
+    assert r.status_code == 200
+    assert r.json() == {"datetime": "2024-03-06T09:30:00+08:00", "weekdayNum": 3, "timezone": "Asia/Hong_Kong"}